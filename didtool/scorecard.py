@@ -1,12 +1,51 @@
 # -*- coding:utf-8 -*-
 import os
-import math
+import functools
 
 from sklearn.base import TransformerMixin, BaseEstimator
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, fall back to numpy
+    njit = None
+
+
+@functools.lru_cache(maxsize=None)
+def _make_score_kernel(n_bins):
+    """
+    Build a numba kernel with `n_bins` frozen as a constant. Anchor nodes
+    sit at 0, the mean_prob of each equal-width bin and 1, so the linear
+    piece of a probability is found with a multiply instead of a search.
+    Closures can not be cached on disk by numba, so the kernel is compiled
+    lazily on its first call in every process (about 0.5s per dtype).
+    Returns None if numba is not installed.
+    """
+    if njit is None:
+        return None
+
+    @njit(parallel=True)
+    def kernel(x, xp, fp, out):
+        last = n_bins + 1
+        for i in prange(x.size):
+            v = x[i]
+            if v >= xp[last]:
+                s = fp[last]
+            elif v > xp[0]:
+                j = min(int(v * n_bins + 0.5), n_bins)
+                if v == xp[j]:
+                    s = fp[j]
+                else:
+                    s = (fp[j + 1] - fp[j]) / (xp[j + 1] - xp[j]) * \
+                        (v - xp[j]) + fp[j]
+            else:
+                s = fp[0]
+            out[i] = np.rint(s)
+
+    return kernel
+
 
 class ScoreCardTransformer(BaseEstimator, TransformerMixin):
     """
@@ -30,26 +69,76 @@ class ScoreCardTransformer(BaseEstimator, TransformerMixin):
         Whether label=1 indicates a good user. In credit model, label=1
         usually indicates that user is bad because of overdue order.
 
+    cache_transform : bool(default=False)
+        Whether to keep the scores of the last `transform` call and return
+        them again when the same array object is passed in. Only shape,
+        dtype and the first/last values are checked, so do not enable it if
+        arrays are modified in place between calls. Scores of cached ndarray
+        input are returned as read-only arrays, copy them before modifying.
+        The last input array stays referenced, and so in memory, until
+        another ndarray is transformed or `fit` is called. Lists and empty
+        arrays are never cached.
+
+    use_numba : bool(default=False)
+        Whether `transform` scores with a parallel numba kernel. The kernel
+        is compiled on the first `transform` for each `n_bins` and input
+        dtype, which takes about 0.5s per process and is not cached on disk,
+        so only enable it for large batches or long-running scoring jobs.
+        Falls back to numpy if numba is not installed.
+
     Attributes
     --------
     _step: float
         equals to 1.0 / `self._n_bins`
 
+    _prob_l, _prob_r : numpy.array
+        left and right edges of each bin
+
+    _bins : dict of numpy.array
+        probability range, hits, odds and score of each bin
+
+    binning_df : DataFrame
+        `_bins` as a DataFrame, for plotting and inspection
+
     mapping_df : DataFrame
         records slope and intercept of each bin
+
+    _xp, _fp : numpy.array
+        prob and score of the anchor nodes linked by `mapping_df`
+
+    _kernel : callable or None
+        numba scoring kernel specialized for `n_bins`, None unless
+        `use_numba` is set and numba is installed
+
+    _hit_rate, _pos_rate : numpy.array
+        share of samples and positive rate of each bin, used by `plot_bins`
     """
 
     def __init__(self, n_bins=20, standard_score=500, standard_odds=0.01,
-                 pdo=20, bad_flag=True):
+                 pdo=20, bad_flag=True, cache_transform=False,
+                 use_numba=False):
         self._n_bins = n_bins
         self._standard_score = standard_score
         self._standard_odds = standard_odds
         self._pdo = pdo
         self._bad_flag = bad_flag
+        self._cache_transform = cache_transform
+        self._use_numba = use_numba
 
         self._step = 1.0 / self._n_bins
-        self.binning_df = None
+        self._prob_l = np.arange(0, 1.0, self._step)
+        self._prob_r = self._prob_l + self._step
+        self._bins = None
+        self._binning_df = None
         self.mapping_df = None
+        self._xp = None
+        self._fp = None
+        self._kernel = None
+        self._hit_rate = None
+        self._pos_rate = None
+        self._last_input = None
+        self._last_key = None
+        self._last_scores = None
 
     def fit(self, x, y):
         """
@@ -70,14 +159,41 @@ class ScoreCardTransformer(BaseEstimator, TransformerMixin):
             raise ValueError(r"Row size of x(%s) and y(%s) do not match."
                              % (x.shape[0], y.shape[0]))
 
-        self.binning_df = self.__calc_bins(x, y)
+        self._bins = self.__calc_bins(x, y)
+        self._binning_df = None
+        self._xp, self._fp = self.__calc_anchors()
         self.mapping_df = self.__calc_mapping_df()
+        self._kernel = _make_score_kernel(self._n_bins) if self._use_numba \
+            else None
+
+        hits = self._bins['hits']
+        pos_hits = self._bins['bad_hits' if self._bad_flag else 'good_hits']
+        self._hit_rate = hits / hits.sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._pos_rate = pos_hits / hits
+
+        self._last_input = self._last_key = self._last_scores = None
         return self
 
+    @property
+    def binning_df(self):
+        """
+        DataFrame view of `_bins`, built on first access after fit
+        """
+        if self._binning_df is None and self._bins is not None:
+            self._binning_df = pd.DataFrame(self._bins)
+        return self._binning_df
+
     def transform(self, x):
         """
         transform probability value to integer score
 
+        Scores are interpolated between the anchor nodes `_xp`, `_fp` and
+        rounded half to even, so a prob whose exact score ends in .5 (e.g.
+        one halfway between two mean_prob) is rounded consistently. Applying
+        `slope * x + intercept` from `mapping_df` may differ by 1 at such
+        ties because of float rounding in that expression.
+
         Parameters
         ----------
         x : numpy.array, 1-d array
@@ -88,14 +204,44 @@ class ScoreCardTransformer(BaseEstimator, TransformerMixin):
         y : numpy.array, 1-d array
             integer scores with same shape as x.
         """
-        data = pd.DataFrame({'prob': x})
-        data['bin'] = data['prob'].apply(
-            lambda x: int((x + self._step / 2) / self._step))
-        data = data.merge(self.mapping_df[['slope', 'intercept']], how='left',
-                          left_on='bin', right_index=True)
-        res = (data['slope'] * data['prob'] + data['intercept']).apply(
-            lambda x: int(round(x)))
-        return res.values
+        key = self.__input_key(x) if self._cache_transform else None
+        if key is not None and x is self._last_input and \
+                key == self._last_key:
+            return self._last_scores
+
+        scores = self.__score(x)
+
+        if key is not None:
+            # cached scores are shared between calls, protect them
+            scores.flags.writeable = False
+            self._last_input, self._last_key = x, key
+            self._last_scores = scores
+        return scores
+
+    def __score(self, x):
+        x = np.asarray(x)
+        # float32 probabilities are passed on as they are, the numba kernel
+        # reads them without an upcast copy, np.interp converts to float64
+        if x.dtype != np.float32:
+            x = x.astype(np.float64, copy=False)
+        x = np.ascontiguousarray(x)
+        # also false for NaN, so NaN and infinite values are rejected too
+        if not ((x >= 0) & (x <= 1)).all():
+            raise ValueError(r"x should be probabilities in [0.0, 1.0].")
+        out = np.empty(x.size, dtype=np.int64)
+        if self._kernel is not None:
+            self._kernel(x, self._xp, self._fp, out)
+        else:
+            # round straight into the int64 buffer, without a float copy
+            np.rint(np.interp(x, self._xp, self._fp), out=out,
+                    casting='unsafe')
+        return out
+
+    @staticmethod
+    def __input_key(x):
+        if not isinstance(x, np.ndarray) or x.size == 0:
+            return None
+        return x.shape, x.dtype, x.flat[0], x.flat[-1]
 
     @staticmethod
     def __is_one_dim_array(arr):
@@ -106,124 +252,130 @@ class ScoreCardTransformer(BaseEstimator, TransformerMixin):
         execution of pre-binning and setting odds (good/bad) of each bin
         corresponding to the samples
         """
-        score_df = pd.DataFrame({'prob': x, 'label': y})
+        # bin index of each sample, computed in one reused float buffer
+        buf = np.empty(len(x), dtype=np.float64)
         # if bad_flag=True, adjust prob
         if self._bad_flag:
-            score_df['prob'] = 1.0 - score_df['prob']
-        score_df['bin'] = score_df['prob'].apply(lambda x: int(x / self._step))
-
-        binning_df = pd.DataFrame(
-            columns=['prob_l', 'prob_r', 'mean_prob', 'score', 'bad_hits',
-                     'good_hits', 'hits', 'odds'],
-            index=range(self._n_bins)
-        )
-
-        binning_df['hits'] = score_df['label'].groupby(score_df['bin']).count()
+            np.subtract(1.0, x, out=buf, dtype=np.float64)
+            np.divide(buf, self._step, out=buf)
+        else:
+            np.divide(x, self._step, out=buf, dtype=np.float64)
+        bins = buf.astype(np.int64)
+        del buf
+        np.clip(bins, 0, self._n_bins - 1, out=bins)
+
+        hits = np.bincount(bins, minlength=self._n_bins).astype(np.float64)
+        pos_hits = np.bincount(bins, weights=np.asarray(y, dtype=np.float64),
+                               minlength=self._n_bins)
         if self._bad_flag:  # if 1 represent bad label
-            binning_df['bad_hits'] = \
-                score_df['label'].groupby(score_df['bin']).sum()
-            binning_df['good_hits'] = \
-                binning_df['hits'] - binning_df['bad_hits']
+            bad_hits, good_hits = pos_hits, hits - pos_hits
         else:  # if 1 represent good label
-            binning_df['good_hits'] = \
-                score_df['label'].groupby(score_df['bin']).sum()
-            binning_df['bad_hits'] = \
-                binning_df['hits'] - binning_df['good_hits']
+            bad_hits, good_hits = hits - pos_hits, pos_hits
 
-        binning_df['odds'] = binning_df['good_hits'] / (binning_df['bad_hits'])
-        binning_df = self.__adjust_odds(binning_df)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            odds = good_hits / bad_hits
+        adjusted_odds = self.__adjust_odds(odds, hits, good_hits, bad_hits)
 
-        binning_df['prob_l'] = np.arange(0, 1, self._step)
-        binning_df['prob_r'] = binning_df['prob_l'] + self._step
+        bin_data = {'bad_hits': bad_hits, 'good_hits': good_hits,
+                    'hits': hits, 'odds': odds,
+                    'adjusted_odds': adjusted_odds}
         # adjust prob should be done after odds adjusted
         if self._bad_flag:
-            binning_df.sort_values(by='prob_l', ascending=False, inplace=True)
-            binning_df['prob_l'] = np.arange(0, 1, self._step)
-            binning_df['prob_r'] = binning_df['prob_l'] + self._step
-            binning_df.reset_index(drop=True, inplace=True)
+            bin_data = {k: v[::-1].copy() for k, v in bin_data.items()}
 
         # score = standard_score + pdo * ln(odds / standard_odds) / ln(2)
         # reference: (https://zhuanlan.zhihu.com/p/82670834)
-        binning_df['score'] = binning_df['adjusted_odds'].apply(
-            lambda x: int(self._standard_score + self._pdo * math.log2(x / self._standard_odds)))
-        binning_df['mean_prob'] = \
-            (binning_df['prob_l'] + binning_df['prob_r']) / 2
-        return binning_df
-
-    def __adjust_odds(self, df):
+        adjusted_odds = bin_data['adjusted_odds']
+        if not (adjusted_odds > 0).all():
+            raise ValueError(r"Odds of some bins could not be adjusted to a "
+                             r"positive value.")
+        score = (self._standard_score + self._pdo *
+                 np.log2(adjusted_odds / self._standard_odds)).astype(np.int64)
+
+        return dict(prob_l=self._prob_l, prob_r=self._prob_r,
+                    mean_prob=(self._prob_l + self._prob_r) / 2, score=score,
+                    **bin_data)
+
+    def __adjust_odds(self, odds, hits, good_hits, bad_hits):
         """
         adjust odds of each bin when it face to the following scenarios:
             (1) bad hits is zero in the high p-value bins
             (2) good hits is zero in the low p-value bins
             (3) good/bad hits is zero in the middle bins
+        Empty bins never start the adjustment of (1) and (2), they are only
+        adjusted when a non-empty bin closer to the max/min odds started it.
         """
-        odds = df['odds'].fillna(0).values
-        odds[np.isinf(odds)] = 0
+        odds = odds.copy()
+        odds[~np.isfinite(odds)] = 0
+        is_filled = hits > 0
 
         max_odds = odds.max()
         max_odds_index = odds.argmax()
-        min_odds = odds[odds > 0].min()
-        min_odds_index = np.where(odds == min_odds)[0][0]
-
-        # adjust odds in bins with zero good hits from min_odds_index to 0
-        is_zero_good = False
-        for i in range(min_odds_index - 1, -1, -1):
-            if df['good_hits'][i] == 0.0:
-                is_zero_good = True
-            if is_zero_good:
-                min_odds /= 2
-                odds[i] = min_odds
-
-        # adjust odds in bins with zero bad hits from max_odds_index to n_bins
-        is_zero_bad = False
-        for i in range(max_odds_index + 1, self._n_bins):
-            if df['bad_hits'][i] == 0.0:
-                is_zero_bad = True
-            if is_zero_bad:
-                max_odds *= 2
-                odds[i] = max_odds
-
-        # adjust odds in bins from min_odds_index to max_odds_index
-        for i in range(min_odds_index + 1, max_odds_index - 1):
-            if odds[i] == 0.0:
-                if odds[i + 1] != 0.0:
-                    odds[i] = (odds[i - 1] + odds[i + 1]) / 2
-                else:
-                    odds[i] = odds[i - 1]
-
-        df['adjusted_odds'] = odds
-        return df
-
-    def __calc_mapping_df(self):
+        min_odds_index = np.where(odds > 0, odds, np.inf).argmin()
+        min_odds = odds[min_odds_index]
+
+        # adjust odds in bins with zero good hits from min_odds_index to 0,
+        # halving min_odds from the first such bin on
+        idx = np.arange(min_odds_index - 1, -1, -1)
+        is_zero_good = np.logical_or.accumulate(
+            (good_hits[idx] == 0.0) & is_filled[idx])
+        odds[idx[is_zero_good]] = \
+            min_odds * 0.5 ** np.cumsum(is_zero_good)[is_zero_good]
+
+        # adjust odds in bins with zero bad hits from max_odds_index to n_bins,
+        # doubling max_odds from the first such bin on
+        idx = np.arange(max_odds_index + 1, self._n_bins)
+        is_zero_bad = np.logical_or.accumulate(
+            (bad_hits[idx] == 0.0) & is_filled[idx])
+        odds[idx[is_zero_bad]] = \
+            max_odds * 2.0 ** np.cumsum(is_zero_bad)[is_zero_bad]
+
+        # adjust odds in bins from min_odds_index to max_odds_index: a zero
+        # bin takes the last non-zero odds on its left, or the mean of it
+        # and the right neighbour if that one is non-zero
+        if max_odds_index - 1 > min_odds_index + 1:
+            mid = odds[min_odds_index:max_odds_index - 1]
+            right = odds[min_odds_index + 1:max_odds_index]
+            last_nonzero = np.maximum.accumulate(
+                np.where(mid != 0.0, np.arange(mid.size), 0))
+            left = mid[last_nonzero]
+            mid[:] = np.where(mid != 0.0, mid,
+                              np.where(right != 0.0, (left + right) / 2, left))
+
+        return odds
+
+    def __calc_anchors(self):
         """
-        Use (mean_prob, score) in all bins as anchor nodes, link all anchor
-        nodes, then we get a sectional-continuous function from prob value
-        to integer score.
+        Use (mean_prob, score) in all bins as anchor nodes, and extend them
+        to prob 0 and 1 with a margin of `pdo` on the score.
         """
-        anchor = pd.DataFrame(
-            columns=['prob_l', 'score_l', 'prob_r', 'score_r'],
-            index=range(self._n_bins + 1))
-        anchor['prob_l'][1:self._n_bins + 1] = self.binning_df['mean_prob']
-        anchor['score_l'][1:self._n_bins + 1] = self.binning_df['score']
-        anchor['prob_r'][0:self._n_bins] = self.binning_df['mean_prob']
-        anchor['score_r'][0:self._n_bins] = self.binning_df['score']
-        anchor['prob_l'][0] = 0
-        anchor['prob_r'][self._n_bins] = 1
+        scores = self._bins['score']
+        xp = np.empty(self._n_bins + 2)
+        fp = np.empty(self._n_bins + 2)
+        xp[0], xp[self._n_bins + 1] = 0, 1
+        xp[1:self._n_bins + 1] = self._bins['mean_prob']
+        fp[1:self._n_bins + 1] = scores
         if self._bad_flag:
-            anchor['score_l'][0] = max(self.binning_df['score']) + self._pdo
-            anchor['score_r'][self._n_bins] = \
-                min(self.binning_df['score']) - self._pdo / 2
+            fp[0] = scores.max() + self._pdo
+            fp[self._n_bins + 1] = scores.min() - self._pdo / 2
         else:
-            anchor['score_l'][0] = min(self.binning_df['score']) - self._pdo
-            anchor['score_r'][self._n_bins] = \
-                max(self.binning_df['score']) + self._pdo / 2
-
-        den = anchor['prob_r'] - anchor['prob_l']
+            fp[0] = scores.min() - self._pdo
+            fp[self._n_bins + 1] = scores.max() + self._pdo / 2
+        return xp, fp
 
-        mapping_df = pd.DataFrame(index=range(self._n_bins + 1),
-                                  columns=['slope', 'intercept'])
-        mapping_df['slope'] = (anchor['score_r'] - anchor['score_l']) / den
-        mapping_df['intercept'] = (anchor['prob_r'] * anchor['score_l'] - anchor['prob_l'] * anchor['score_r']) / den
+    def __calc_mapping_df(self):
+        """
+        Link all anchor nodes, then we get a sectional-continuous function
+        from prob value to integer score.
+        """
+        prob_l, prob_r = self._xp[:-1], self._xp[1:]
+        score_l, score_r = self._fp[:-1], self._fp[1:]
+        den = prob_r - prob_l
+
+        mapping_df = pd.DataFrame({
+            'slope': (score_r - score_l) / den,
+            'intercept': (prob_r * score_l - prob_l * score_r) / den
+        })
         return mapping_df
 
     def plot_bins(self):
@@ -244,14 +396,10 @@ class ScoreCardTransformer(BaseEstimator, TransformerMixin):
 
         # Create a twin of Axes with a shared x-axis but independent y-axis.
         ax2 = ax1.twinx()
-        hit_rate = self.binning_df['hits'] / self.binning_df['hits'].sum()
-        pos_rate = (self.binning_df['bad_hits'] if self._bad_flag else
-                    self.binning_df['good_hits']) / self.binning_df['hits']
-
-        ax2.bar([i - 0.2 for i in range(self._n_bins)], hit_rate, alpha=0.5,
-                color='blue', width=0.4, label='hit_rate')
-        ax2.bar([i + 0.2 for i in range(self._n_bins)], pos_rate, alpha=0.5,
-                color='red', width=0.4, label='pos_rate')
+        ax2.bar([i - 0.2 for i in range(self._n_bins)], self._hit_rate,
+                alpha=0.5, color='blue', width=0.4, label='hit_rate')
+        ax2.bar([i + 0.2 for i in range(self._n_bins)], self._pos_rate,
+                alpha=0.5, color='red', width=0.4, label='pos_rate')
         ax2.legend(loc=2)
         ax2.set_ylim([0, 1])
         plt.xticks(range(self._n_bins), range(self._n_bins))
@@ -260,5 +408,8 @@ class ScoreCardTransformer(BaseEstimator, TransformerMixin):
     def export_mapping(self, out_path, file_name='map_score_card.csv'):
         """
         save mapping_df to file
+
+        Scores computed from the exported slope and intercept match
+        `transform` except at exact .5 ties, see `transform`.
         """
         self.mapping_df.to_csv(os.path.join(out_path, file_name), index=False)
@@ -1,33 +1,115 @@
 import unittest
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
-from didtool.scorecard import ScoreCardTransformer
+from didtool.scorecard import ScoreCardTransformer, _make_score_kernel
 import random
 
 
 class TestScoreCard(unittest.TestCase):
-    def test_score_card_transformer(self):
+    def setUp(self):
         df = pd.read_csv(str(Path(__file__).parent / 'samples.csv'))[['target']]
 
         random.seed(1)
         df['prob'] = df['target'].apply(
             lambda x: random.uniform(0, 0.8) if x < 1 else random.uniform(0.2,
                                                                           1))
+        self.prob = df['prob'].values
+        self.target = df['target'].values
 
+    def test_score_card_transformer(self):
         transformer = ScoreCardTransformer(bad_flag=True)
-        transformer.fit(df['prob'].values, df['target'].values)
+        transformer.fit(self.prob, self.target)
         # print(transformer.binning_df)
         # print(transformer.mapping_df)
         # transformer.plot_bins()
         scores = transformer.transform([0.05, 0.5, 0.8])
+        self.assertIsInstance(scores, np.ndarray)
+        self.assertEqual(scores.dtype, np.int64)
         self.assertEqual(scores[0], 815)
         self.assertEqual(scores[1], 677)
         self.assertEqual(scores[2], 666)
+        scores_32 = transformer.transform(
+            np.array([0.05, 0.5, 0.8], dtype=np.float32))
+        self.assertListEqual(list(scores_32), [815, 677, 666])
+        for x in ([0.05, np.nan], [-0.1, 0.5], [0.5, 1.2]):
+            with self.assertRaises(ValueError):
+                transformer.transform(x)
+        self.assertListEqual(list(transformer.transform([0.0, 1.0])),
+                             [845, 580])
 
         slope = transformer.mapping_df['slope'][1]
         intercept = transformer.mapping_df['intercept'][1]
         self.assertAlmostEqual(slope, -400)
         self.assertAlmostEqual(intercept, 835)
         self.assertEqual(int(slope * 0.05 + intercept), 815)
+
+        # 0.3 is halfway between the anchors (0.275, 698) and (0.325, 745),
+        # its exact score 721.5 is rounded half to even
+        self.assertEqual(transformer.transform([0.3])[0], 722)
+
+    def test_score_card_transform_cache(self):
+        transformer = ScoreCardTransformer(bad_flag=True, cache_transform=True)
+        transformer.fit(self.prob, self.target)
+        x = np.array([0.05, 0.5, 0.8])
+        scores = transformer.transform(x)
+        self.assertIs(transformer.transform(x), scores)
+        self.assertFalse(scores.flags.writeable)
+        self.assertListEqual(list(scores), [815, 677, 666])
+
+        x[-1] = 0.05
+        self.assertListEqual(list(transformer.transform(x)), [815, 677, 815])
+
+        # lists are never cached
+        scores = transformer.transform([0.05, 0.5, 0.8])
+        self.assertTrue(scores.flags.writeable)
+        self.assertIsNot(transformer._last_scores, scores)
+
+    @unittest.skipIf(_make_score_kernel(20) is None, 'numba is not installed')
+    def test_score_card_transform_numba(self):
+        transformer = ScoreCardTransformer(bad_flag=True, use_numba=True)
+        transformer.fit(self.prob, self.target)
+        self.assertIsNotNone(transformer._kernel)
+        kernel = transformer._kernel
+        for dtype in (np.float64, np.float32):
+            x = np.linspace(0, 1, 1001, dtype=dtype)
+            transformer._kernel = kernel
+            scores = transformer.transform(x)
+            transformer._kernel = None
+            np.testing.assert_array_equal(scores, transformer.transform(x))
+
+    def test_adjust_odds(self):
+        def adjust_odds(good_hits, bad_hits, hits=None):
+            good_hits = np.array(good_hits, dtype=float)
+            bad_hits = np.array(bad_hits, dtype=float)
+            hits = good_hits + bad_hits if hits is None else \
+                np.array(hits, dtype=float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                odds = good_hits / bad_hits
+            transformer = ScoreCardTransformer(n_bins=len(good_hits))
+            return transformer._ScoreCardTransformer__adjust_odds(
+                odds, hits, good_hits, bad_hits)
+
+        # zero good hits below min odds, zero bad hits above max odds and a
+        # single zero bin in the middle
+        np.testing.assert_array_equal(
+            adjust_odds([0, 1, 0, 2, 4, 5, 3, 2], [2, 2, 1, 1, 1, 0, 1, 0]),
+            [0.25, 0.5, 1.25, 2, 4, 8, 16, 32])
+        # consecutive zero bins in the middle
+        np.testing.assert_array_equal(
+            adjust_odds([1, 2, 0, 0, 0, 3, 0, 4, 8], [1, 1, 1, 2, 1, 1, 1, 1, 1]),
+            [1, 2, 2, 2, 2.5, 3, 3.5, 4, 8])
+        # max odds on the left of min odds
+        np.testing.assert_array_equal(
+            adjust_odds([8, 0, 2, 1, 0], [1, 1, 0, 1, 2]),
+            [0.25, 0.5, 16, 32, 64])
+        # a non-empty bin with zero good hits starts halving min_odds
+        np.testing.assert_array_equal(
+            adjust_odds([0, 2, 3, 4, 6], [3, 2, 1, 1, 1], [3, 4, 4, 5, 7]),
+            [0.5, 1, 3, 4, 6])
+        # an empty bin does not
+        np.testing.assert_array_equal(
+            adjust_odds([0, 2, 3, 4, 6], [0, 2, 1, 1, 1], [0, 4, 4, 5, 7]),
+            [0, 1, 3, 4, 6])